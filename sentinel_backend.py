@@ -1,9 +1,31 @@
+import hashlib
+import numpy as np
+import orjson
+import os
 import pandas as pd
 import random
-from flask import Flask, jsonify, request
+import sys
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-from pytrends.request import TrendReq
-from datetime import datetime, timedelta
+from pytrends import exceptions as pytrends_exceptions
+from pytrends.request import BASE_TRENDS_URL, TrendReq
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+from cachetools import TLRUCache
+
+# Numba is optional: when installed it compiles the numeric scoring core
+# (see _score_core); without it the same code runs as plain Python
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # --- 1. Flask App Setup ---
 app = Flask(__name__)
@@ -11,111 +33,645 @@ app = Flask(__name__)
 CORS(app)
 
 # --- 2. Cache Configuration ---
-# This is our simple in-memory cache to avoid Google's 429 error
-trends_cache = {}
-CACHE_DURATION = timedelta(minutes=10) # Store data for 10 minutes
+# This is our simple in-memory cache to avoid Google's 429 error.
+# Every entry carries its own 'ttl' (in seconds, see adaptive_cache_ttl);
+# TLRUCache drops entries once that expires and evicts the least recently
+# used ones once CACHE_MAXSIZE is reached, so memory stays bounded.
+CACHE_DURATION = 600 # Default lifetime: 10 minutes (in seconds)
+CACHE_MAXSIZE = 256
+# Failed or empty fetches (e.g. a 429 from Google) are cached briefly so
+# we back off for a minute, then try again instead of waiting out a full TTL
+NEGATIVE_CACHE_TTL = 60
+
+# All cache and refresh times come from one monotonic clock: plain float
+# seconds (no datetime objects on the lookup path) that never jump when
+# the wall clock is adjusted, so TTLs can't suddenly expire or stick
+CACHE_TIMER = time.monotonic
+
+def _entry_expiry(_key, entry, now):
+    return now + entry['ttl']
+
+trends_cache = TLRUCache(maxsize=CACHE_MAXSIZE, ttu=_entry_expiry, timer=CACHE_TIMER)
+
+# Finished API responses, keyed by (disease, city, geo). Entries are
+# {'body': json_bytes, 'etag': ..., 'ttl': ...}; 'ttl' is whatever is left
+# of the trends entry they were built from, and they are dropped as soon
+# as that trends entry is replaced (see drop_cached_responses)
+response_cache = TLRUCache(maxsize=CACHE_MAXSIZE, ttu=_entry_expiry, timer=CACHE_TIMER)
+
+# TLRUCache is not thread-safe; the request threads and the background
+# refresher share both caches through this lock
+cache_lock = threading.RLock()
+
+# --- Shared Trends Cache (optional) ---
+# With several gunicorn workers, set SENTINEL_REDIS_URL (e.g.
+# redis://localhost:6379/0) so they all share one trends cache in Redis
+# instead of each worker calling Google for its own copy. Entries are
+# msgpack-encoded and expire through Redis' own TTL. A live fetch holds a
+# Redis lock for its key, so only one worker at a time calls Google for it;
+# the others wait for its result to show up in Redis.
+REDIS_URL = os.getenv('SENTINEL_REDIS_URL')
+# The lock is renewed every third of its lifetime while the fetch runs, so
+# a slow fetch keeps it and a crashed worker's lock frees up within 30s
+SHARED_LOCK_MS = 30_000
+SHARED_LOCK_RENEW_SECONDS = SHARED_LOCK_MS / 1000 / 3
+SHARED_LOCK_POLL_SECONDS = 0.5
+
+# Compare-and-delete / compare-and-extend, so a worker only ever touches
+# the lock while it still holds its own token
+_UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+if REDIS_URL:
+    import msgpack
+    import redis
+    redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=False)
+    redis_unlock = redis_client.register_script(_UNLOCK_SCRIPT)
+    redis_renew_lock = redis_client.register_script(_RENEW_LOCK_SCRIPT)
+else:
+    redis_client = None
+
+# --- Background Refresh Configuration ---
+# Every (disease, geo) pair that has been fetched successfully and is being
+# requested is re-fetched in the background halfway through its cache
+# entry's TTL, so requests rarely block on Google. Pairs that never
+# returned data (e.g. a typo'd geo) are never scheduled, and pairs nobody
+# has asked for in a while drop out of the schedule again.
+REFRESH_INTERVAL = CACHE_DURATION / 2 # Used until a fetch has set a TTL
+REFRESH_IDLE_LIMIT = 3600 # Stop refreshing after 1 hour without requests
+REFRESH_MAX_BACKOFF = 1800 # Longest wait between retries of a failing pair
+REFRESH_POLL_SECONDS = 5
+
+def _job_idle_expiry(_key, _job, now):
+    return now + REFRESH_IDLE_LIMIT
+
+# cache_key -> {'disease_config', 'geo', 'next_refresh', 'failures'}.
+# Re-inserting a job when it is requested restarts its idle timer.
+refresh_schedule = TLRUCache(maxsize=CACHE_MAXSIZE, ttu=_job_idle_expiry, timer=CACHE_TIMER)
+refresh_lock = threading.Lock()
+_refresher_thread = None
+
+# Worker pool for fetching several diseases at once (/api/threat_batch).
+# pytrends calls are blocking network I/O, so threads overlap the waits.
+TRENDS_MAX_WORKERS = 4
+trends_executor = ThreadPoolExecutor(max_workers=TRENDS_MAX_WORKERS, thread_name_prefix='trends-fetch')
+
+# --- Google Trends HTTP Session ---
+# One pooled session for every call to trends.google.com, so keep-alive
+# connections (and their TLS handshakes) are reused across cache misses
+TRENDS_SESSION = requests.Session()
+TRENDS_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, allowed_methods=frozenset(['GET', 'POST']))
+))
+
+class PooledTrendReq(TrendReq):
+    """
+    TrendReq that sends its requests through TRENDS_SESSION.
+    Stock pytrends opens a brand new session for every call.
+    Overrides pytrends' private GetGoogleCookie/_get_data as written in
+    pytrends 4.9.2 (pinned in requirments.txt); re-check them before
+    upgrading. Proxy support (proxies=, GetNewProxy) is not carried over.
+    """
+    def GetGoogleCookie(self):
+        response = TRENDS_SESSION.get(
+            f'{BASE_TRENDS_URL}/explore/?geo={self.hl[-2:]}',
+            timeout=self.timeout,
+            **self.requests_args
+        )
+        return dict(filter(lambda i: i[0] == 'NID', response.cookies.items()))
+
+    def _get_data(self, url, method=TrendReq.GET_METHOD, trim_chars=0, **kwargs):
+        send = TRENDS_SESSION.post if method == TrendReq.POST_METHOD else TRENDS_SESSION.get
+        response = send(url, timeout=self.timeout, cookies=self.cookies,
+                        headers=self.headers, **kwargs, **self.requests_args)
+        # Google answers with JSON under several content types, prefixed
+        # with garbage like ")]}'," that trim_chars strips off
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code == 200 and any(t in content_type for t in (
+                'application/json', 'application/javascript', 'text/javascript')):
+            return orjson.loads(response.text[trim_chars:])
+        if response.status_code == requests.codes.too_many_requests:
+            raise pytrends_exceptions.TooManyRequestsError.from_response(response)
+        raise pytrends_exceptions.ResponseError.from_response(response)
+
+# --- Google Trends Rate Limiting ---
+# A burst of cold requests must not turn into a burst of calls to Google
+# (that is exactly what triggers 429s). At most TRENDS_MAX_CONCURRENT
+# fetches run at once, and they start at TRENDS_RATE_PER_SECOND on
+# average with bursts of up to TRENDS_BURST.
+TRENDS_MAX_CONCURRENT = 4
+TRENDS_RATE_PER_SECOND = 0.5
+TRENDS_BURST = 4
+
+class TokenBucket:
+    """
+    Hands out `rate` tokens per second, holding at most `capacity`.
+    acquire() blocks until a token is available.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = CACHE_TIMER()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = CACHE_TIMER()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+trends_rate_limiter = TokenBucket(TRENDS_RATE_PER_SECOND, TRENDS_BURST)
+_pytrends_slots = threading.BoundedSemaphore(TRENDS_MAX_CONCURRENT)
+
+# Idle pytrends clients, reused across fetches so the constructor (and its
+# cookie request) runs once per client instead of once per cache miss.
+# A client holds per-query state, so each one serves one fetch at a time.
+_pytrends_pool = queue.LifoQueue()
+
+@contextmanager
+def borrow_pytrends():
+    """
+    Lends out an idle pytrends client, creating one if needed. Blocks
+    while TRENDS_MAX_CONCURRENT fetches are running or the rate limit
+    is used up.
+    """
+    with _pytrends_slots:
+        trends_rate_limiter.acquire()
+        try:
+            client = _pytrends_pool.get_nowait()
+        except queue.Empty:
+            client = PooledTrendReq(hl='en-US', tz=360, timeout=(10, 25))
+        try:
+            yield client
+        finally:
+            _pytrends_pool.put(client)
+
+# Fetches currently talking to Google, keyed by trends cache key. Anyone
+# who needs the same data waits on the Event instead of fetching again.
+_inflight = {}
+_inflight_lock = threading.Lock()
 
 # --- 3. Disease Keyword Configuration ---
 DISEASE_KEYWORDS = {
     'flu': {
         'keywords': ['flu symptoms', 'fever and cough', 'influenza treatment', 'Tamifu'],
-        'baseline_factor': 1.2
+        'baseline_factor': 1.2,
+        'ttl_base': 600 # seconds
     },
     'dengue': {
         'keywords': ['dengue symptoms', 'mosquito bite fever', 'platelet count low', 'dengue treatment'],
-        'baseline_factor': 1.5
+        'baseline_factor': 1.5,
+        'ttl_base': 600 # seconds
     },
     'covid': {
         'keywords': ['covid symptoms', 'loss of smell', 'covid test near me', 'Paxlovid'],
-        'baseline_factor': 1.3
+        'baseline_factor': 1.3,
+        'ttl_base': 600 # seconds
     }
 }
 
+# Precompute the keyword part of each trends cache key once. Sorting makes
+# the key independent of keyword order, and a tuple hashes without
+# building a joined string on every request.
+for _config in DISEASE_KEYWORDS.values():
+    _config['cache_key_suffix'] = tuple(sorted(_config['keywords']))
+
+# Lookup table for validating the ?disease= parameter
+_VALID_DISEASES = frozenset(DISEASE_KEYWORDS)
+
 # --- 4. Data Source 1: Google Trends (with Caching) ---
 def get_google_trends(disease_config, geo):
     """
-    Fetches Google Trends data, using a cache to avoid rate limits.
-    Returns a tuple: (pandas_dataframe, chart_js_data_dict)
+    Returns Google Trends data from the cache, fetching it live only the
+    first time a (disease, geo) pair is seen. Once a pair has returned
+    data, the background refresher keeps its entry warm.
+    Returns a tuple: ((baseline_avg, current_avg), chart_js_data_dict, expires_at)
+    expires_at is when the trends data expires (on CACHE_TIMER's clock),
+    or None when there is no data.
     """
     
     # --- Cache Check Logic ---
     # 1. Create a unique key for this request
-    cache_key = f"{geo}_{'_'.join(disease_config['keywords'])}"
+    cache_key = (geo, disease_config['cache_key_suffix'])
     
     # 2. Check if a valid, non-expired entry exists
-    if cache_key in trends_cache:
-        entry = trends_cache[cache_key]
-        if datetime.now() - entry['timestamp'] < CACHE_DURATION:
-            print(f"[Cache] HIT! Serving cached data for {cache_key}.")
-            return entry['data'], entry['chart_data']
-        else:
-            print(f"[Cache] STALE. Entry for {cache_key} expired.")
-    else:
-        print(f"[Cache] MISS. No data for {cache_key}.")
-        
+    entry = read_trends_cache(cache_key)
+    if entry is not None:
+        if not entry['ok']:
+            print(f"[Cache] NEGATIVE HIT. Recent fetch for {cache_key} failed, not retrying yet.")
+            return None, None, None
+        print(f"[Cache] HIT! Serving cached data for {cache_key}.")
+        schedule_refresh(cache_key, disease_config, geo, entry['expires_at'])
+        return entry['trend_averages'], entry['chart_data'], entry['expires_at']
+    print(f"[Cache] MISS. No fresh data for {cache_key}.")
+    
+    trend_averages, chart_data, expires_at = fetch_google_trends(disease_config, geo)
+    if chart_data is not None:
+        schedule_refresh(cache_key, disease_config, geo, expires_at)
+    return trend_averages, chart_data, expires_at
+
+def fetch_google_trends(disease_config, geo, force=False):
+    """
+    Fetches live Google Trends data and stores it in the cache. If the same
+    data is already being fetched, waits for that fetch and reads its
+    result from the cache instead (request coalescing). Unless force is
+    set (background refresh), a cache entry that appeared in the meantime
+    is used instead of calling Google.
+    Returns a tuple: ((baseline_avg, current_avg), chart_js_data_dict, expires_at)
+    """
+    cache_key = (geo, disease_config['cache_key_suffix'])
+    with _inflight_lock:
+        done = _inflight.get(cache_key)
+        is_leader = done is None
+        if is_leader:
+            done = _inflight[cache_key] = threading.Event()
+    
+    if not is_leader:
+        print(f"[Trends] Waiting for in-flight fetch of {cache_key}...")
+        done.wait()
+        return _cached_trends_result(read_trends_cache(cache_key))
+    
+    try:
+        with shared_fetch_lock(cache_key) as acquired:
+            if not acquired:
+                # Another worker is fetching this key right now
+                if force:
+                    return _cached_trends_result(read_trends_cache(cache_key))
+                print(f"[Trends] Waiting for another worker's fetch of {cache_key}...")
+                return _cached_trends_result(wait_for_shared_fetch(cache_key))
+            if not force:
+                # The previous leader may have filled the cache between our
+                # miss and becoming leader; don't ask Google again for it
+                entry = read_trends_cache(cache_key)
+                if entry is not None:
+                    print(f"[Cache] HIT! {cache_key} was filled by a fetch that just finished.")
+                    return _cached_trends_result(entry)
+            return _fetch_google_trends_live(disease_config, geo, cache_key)
+    finally:
+        with _inflight_lock:
+            del _inflight[cache_key]
+        done.set()
+
+def _cached_trends_result(entry):
+    """
+    Turns a trends cache entry (or None) into fetch_google_trends' tuple.
+    """
+    if entry is None or not entry['ok']:
+        return None, None, None
+    return entry['trend_averages'], entry['chart_data'], entry['expires_at']
+
+def _fetch_google_trends_live(disease_config, geo, cache_key):
+    """
+    Does the actual pytrends call for fetch_google_trends.
+    """
     print(f"[Trends] Fetching LIVE Google Trends data for geo={geo}...")
     
     try:
-        # A. Initialize Pytrends
-        pytrends = TrendReq(hl='en-US', tz=360, timeout=(10, 25))
-        
-        # B. Define the time window (Last 30 days)
+        # A. Define the time window (Last 30 days)
         timeframe = 'today 1-m' # 1-m means "one month"
         
-        # C. Build the query payload
-        pytrends.build_payload(
-            kw_list=disease_config['keywords'],
-            cat=0,
-            timeframe=timeframe,
-            geo=geo,
-            gprop=''
-        )
-        
-        # D. Make the API call
-        trends_df = pytrends.interest_over_time()
+        with borrow_pytrends() as pytrends:
+            # B. Build the query payload
+            pytrends.build_payload(
+                kw_list=disease_config['keywords'],
+                cat=0,
+                timeframe=timeframe,
+                geo=geo,
+                gprop=''
+            )
+            
+            # C. Make the API call
+            trends_df = pytrends.interest_over_time()
 
         if trends_df.empty:
             print("[Trends] No data returned from Google Trends.")
-            # Cache the "no data" result so we don't ask again
-            trends_cache[cache_key] = {
-                'timestamp': datetime.now(),
-                'data': None,
-                'chart_data': None
-            }
-            return None, None
+            # Cache the "no data" result briefly so we don't ask again right away
+            store_negative_result(cache_key)
+            return None, None, None
 
+        # D. Reduce the keyword columns to the two averages the threat
+        # score needs, so the DataFrame itself is never cached
+        kw_matrix = trends_df[disease_config['keywords']].to_numpy(dtype=np.float32, copy=False)
+        baseline_avg, current_avg, volatility = summarize_trends(kw_matrix)
+        trend_averages = (baseline_avg, current_avg)
+        ttl = adaptive_cache_ttl(disease_config, volatility)
+        
         # E. Prepare data for Chart.js (for Person 2)
+        # Add all keywords to the chart dataset, converting the whole
+        # keyword block to per-keyword lists in one go
+        columns = [k for k in disease_config['keywords'] if k in trends_df.columns]
+        data_lists = trends_df[columns].to_numpy().T.tolist()
         chart_data = {
             'labels': trends_df.index.strftime('%Y-%m-%d').tolist(), # X-axis
-            'datasets': []
+            'datasets': [
+                {'label': keyword, 'data': data}
+                for keyword, data in zip(columns, data_lists)
+            ]
         }
         
-        # Add all keywords to the chart dataset
-        for keyword in disease_config['keywords']:
-            if keyword in trends_df.columns:
-                chart_data['datasets'].append({
-                    'label': keyword,
-                    'data': trends_df[keyword].tolist()
-                })
-        
-        print("[Trends] Successfully fetched and processed Google Trends data.")
+        print(f"[Trends] Successfully fetched and processed Google Trends data (ttl={ttl:.0f}s).")
         
         # --- Store in Cache ---
         # 3. Store the new, good data in our cache
-        trends_cache[cache_key] = {
-            'timestamp': datetime.now(),
-            'data': trends_df,
-            'chart_data': chart_data
-        }
+        expires_at = write_trends_cache(cache_key, {
+            'ok': True,
+            'trend_averages': trend_averages,
+            'chart_data': chart_data,
+            'ttl': ttl
+        })
+        reschedule_refresh(cache_key, ttl)
         
-        return trends_df, chart_data
+        return trend_averages, chart_data, expires_at
 
     except Exception as e:
         print(f"[Trends] !!! ERROR: Failed to get Google Trends data: {e}")
+        store_negative_result(cache_key)
         # Return empty/null objects so the app doesn't crash
-        return None, None
+        return None, None, None
+
+def store_negative_result(cache_key):
+    """
+    Caches a failed fetch for NEGATIVE_CACHE_TTL seconds. Good data that is
+    still fresh is kept, so a failed background refresh never replaces it.
+    """
+    with cache_lock:
+        entry = read_trends_cache(cache_key)
+        if entry is None or not entry['ok']:
+            write_trends_cache(cache_key, {
+                'ok': False,
+                'trend_averages': None,
+                'chart_data': None,
+                'ttl': NEGATIVE_CACHE_TTL
+            })
+    reschedule_refresh(cache_key)
+
+def read_trends_cache(cache_key):
+    """
+    Returns the live trends cache entry for cache_key, or None. The entry
+    includes 'expires_at', on this process's CACHE_TIMER clock.
+    Reads from Redis when SENTINEL_REDIS_URL is set, else from memory.
+    """
+    if redis_client is None:
+        with cache_lock:
+            return trends_cache.get(cache_key)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.get(_redis_key(cache_key))
+        pipe.pttl(_redis_key(cache_key))
+        raw, remaining_ms = pipe.execute()
+    except redis.RedisError as e:
+        # Treat an unreachable Redis as a miss rather than failing the request
+        print(f"[Cache] !!! ERROR: Redis read failed: {e}")
+        return None
+    # PTTL is negative if the key expired between the two commands
+    if raw is None or remaining_ms <= 0:
+        return None
+    entry = msgpack.unpackb(raw)
+    entry['expires_at'] = CACHE_TIMER() + remaining_ms / 1000
+    return entry
+
+def write_trends_cache(cache_key, entry):
+    """
+    Stores a trends cache entry for entry['ttl'] seconds and drops any
+    responses built from the entry it replaces.
+    Returns when the new entry expires (on CACHE_TIMER's clock).
+    """
+    expires_at = CACHE_TIMER() + entry['ttl']
+    drop_cached_responses(cache_key)
+    if redis_client is None:
+        with cache_lock:
+            trends_cache[cache_key] = dict(entry, expires_at=expires_at)
+        return expires_at
+    try:
+        redis_client.set(_redis_key(cache_key), msgpack.packb(entry), px=int(entry['ttl'] * 1000))
+    except redis.RedisError as e:
+        print(f"[Cache] !!! ERROR: Redis write failed: {e}")
+    return expires_at
+
+def drop_cached_responses(cache_key):
+    """
+    Removes every response_cache entry built from the trends data under
+    cache_key, so the next request picks up the new data.
+    """
+    geo, keywords = cache_key
+    with cache_lock:
+        stale = [
+            key for key in response_cache
+            if key[2] == geo and DISEASE_KEYWORDS[key[0]]['cache_key_suffix'] == keywords
+        ]
+        for key in stale:
+            response_cache.pop(key, None)
+
+def _redis_key(cache_key, kind='trends'):
+    geo, keywords = cache_key
+    return f"sentinel:{kind}:{geo}:{'|'.join(keywords)}"
+
+@contextmanager
+def shared_fetch_lock(cache_key):
+    """
+    Cross-worker lock (SET NX in Redis) around a live fetch of cache_key.
+    Yields whether this worker holds it; while it does, a background
+    thread keeps renewing the lock. Without Redis, or if Redis can't be
+    reached, it always yields True and the fetch goes ahead.
+    """
+    if redis_client is None:
+        yield True
+        return
+    lock_key = _redis_key(cache_key, 'lock')
+    token = os.urandom(8).hex().encode()
+    try:
+        acquired = bool(redis_client.set(lock_key, token, nx=True, px=SHARED_LOCK_MS))
+    except redis.RedisError as e:
+        print(f"[Cache] !!! ERROR: Redis lock failed, fetching anyway: {e}")
+        acquired, token = True, None
+    held = acquired and token is not None
+    released = threading.Event()
+    if held:
+        threading.Thread(
+            target=_renew_shared_lock, args=(lock_key, token, released),
+            name='trends-lock-renewal', daemon=True
+        ).start()
+    try:
+        yield acquired
+    finally:
+        if held:
+            released.set()
+            # Only release our own lock, not one that expired and was retaken
+            try:
+                redis_unlock(keys=[lock_key], args=[token])
+            except redis.RedisError as e:
+                print(f"[Cache] !!! ERROR: Redis unlock failed: {e}")
+
+def _renew_shared_lock(lock_key, token, released):
+    """
+    Extends a held fetch lock every SHARED_LOCK_RENEW_SECONDS until it is
+    released, or until it turns out to have been lost.
+    """
+    while not released.wait(SHARED_LOCK_RENEW_SECONDS):
+        try:
+            if not redis_renew_lock(keys=[lock_key], args=[token, SHARED_LOCK_MS]):
+                print(f"[Cache] !!! ERROR: Lost Redis lock {lock_key} mid-fetch.")
+                return
+        except redis.RedisError as e:
+            print(f"[Cache] !!! ERROR: Redis lock renewal failed: {e}")
+
+def wait_for_shared_fetch(cache_key):
+    """
+    Waits for another worker's fetch of cache_key to land in Redis.
+    Returns the cache entry, or None if that fetch ended without one.
+    The other worker renews its lock for as long as it is fetching, and
+    a lock it stops renewing (e.g. it crashed) expires on its own.
+    """
+    lock_key = _redis_key(cache_key, 'lock')
+    while True:
+        time.sleep(SHARED_LOCK_POLL_SECONDS)
+        entry = read_trends_cache(cache_key)
+        if entry is not None:
+            return entry
+        try:
+            if not redis_client.exists(lock_key):
+                return read_trends_cache(cache_key)
+        except redis.RedisError as e:
+            print(f"[Cache] !!! ERROR: Redis read failed: {e}")
+            return None
+
+def shared_refresh_delay(cache_key):
+    """
+    Seconds until the shared (Redis) entry for cache_key is halfway through
+    its TTL, i.e. until it needs a refresh. Another worker may have just
+    refreshed it. 0 when it is due now, or when there is no shared cache.
+    """
+    if redis_client is None:
+        return 0
+    try:
+        pipe = redis_client.pipeline()
+        pipe.pttl(_redis_key(cache_key))
+        pipe.get(_redis_key(cache_key))
+        remaining_ms, raw = pipe.execute()
+    except redis.RedisError as e:
+        print(f"[Cache] !!! ERROR: Redis read failed: {e}")
+        return 0
+    # PTTL is negative when the key is missing or has no expiry
+    if raw is None or remaining_ms <= 0:
+        return 0
+    entry = msgpack.unpackb(raw)
+    return max(0.0, remaining_ms / 1000 - entry['ttl'] / 2)
+
+def adaptive_cache_ttl(disease_config, volatility):
+    """
+    Scales the disease's ttl_base by how volatile its search totals are:
+    flat series are kept for up to 2x ttl_base, spiky ones for as little
+    as 0.25x, so fast-moving outbreaks are refreshed more often.
+    """
+    factor = min(max(2.0 / (1.0 + volatility), 0.25), 2.0)
+    return disease_config['ttl_base'] * factor
+
+def schedule_refresh(cache_key, disease_config, geo, expires_at):
+    """
+    Registers a (disease, geo) pair that has returned data with the
+    background refresher, or marks it as recently requested if it is
+    already scheduled. A new pair is refreshed halfway to expires_at.
+    """
+    now = CACHE_TIMER()
+    with refresh_lock:
+        job = refresh_schedule.get(cache_key)
+        if job is None:
+            job = {
+                'disease_config': disease_config,
+                'geo': geo,
+                'next_refresh': now + max(expires_at - now, 0) / 2,
+                'failures': 0
+            }
+        # (Re-)inserting restarts the job's idle timer
+        refresh_schedule[cache_key] = job
+    start_refresher()
+
+def reschedule_refresh(cache_key, ttl=None):
+    """
+    Sets when a scheduled pair is refreshed next. After a successful fetch
+    (ttl given) that is halfway through the new entry's TTL; after a failed
+    one it backs off exponentially, up to REFRESH_MAX_BACKOFF.
+    """
+    with refresh_lock:
+        job = refresh_schedule.get(cache_key)
+        if job is None:
+            return
+        if ttl is not None:
+            job['failures'] = 0
+            delay = ttl / 2
+        else:
+            job['failures'] += 1
+            delay = min(NEGATIVE_CACHE_TTL / 2 * 2 ** job['failures'], REFRESH_MAX_BACKOFF)
+        job['next_refresh'] = CACHE_TIMER() + delay
+
+def start_refresher():
+    """
+    Starts the background refresh thread once per process.
+    """
+    global _refresher_thread
+    with refresh_lock:
+        if _refresher_thread is not None:
+            return
+        _refresher_thread = threading.Thread(
+            target=_refresh_loop, name='trends-refresher', daemon=True
+        )
+    _refresher_thread.start()
+
+def _refresh_loop():
+    """
+    Re-fetches every scheduled pair that is due, forever.
+    """
+    while True:
+        time.sleep(REFRESH_POLL_SECONDS)
+        now = CACHE_TIMER()
+        due = []
+        with refresh_lock:
+            # Idle pairs expire out of the schedule on their own
+            refresh_schedule.expire()
+            for cache_key, job in list(refresh_schedule.items()):
+                if now >= job['next_refresh']:
+                    job['next_refresh'] = now + REFRESH_INTERVAL
+                    due.append((cache_key, job))
+        # Fetch outside the lock so requests can still register new pairs
+        for cache_key, job in due:
+            # One bad job must not kill the thread and stop every refresh
+            try:
+                # With a shared cache another worker may already have refreshed
+                # this entry; if so, just come back when it is due again
+                delay = shared_refresh_delay(cache_key)
+                if delay > 0:
+                    with refresh_lock:
+                        job['next_refresh'] = CACHE_TIMER() + delay
+                    continue
+                fetch_google_trends(job['disease_config'], job['geo'], force=True)
+            except Exception as e:
+                print(f"[Refresh] !!! ERROR: Refresh of {cache_key} failed: {e}")
+                reschedule_refresh(cache_key)
 
 # --- 5. Data Source 2: Social Media (Mocked) ---
+# Dedicated generator for the mock score, seeded once at import. Under
+# gevent each request is its own greenlet, so a per-thread generator
+# would be rebuilt (and re-seeded from urandom) on every request.
+_SOCIAL_RNG = random.Random()
+
 def get_social_chatter(disease_config, city):
     """
     MOCK FUNCTION
@@ -123,57 +679,109 @@ def get_social_chatter(disease_config, city):
     """
     print(f"[MOCK] Simulating Reddit scan for '{city}'... (returning a random score)")
     # Return a random score to make the demo dynamic
-    return random.randint(5, 50)
+    return _SOCIAL_RNG.randrange(5, 51)
 
 # --- 6. Core Logic: Threat Score Calculation ---
-def calculate_threat_score(trends_df, social_score, disease_config):
+def summarize_trends(kw_matrix):
+    """
+    Reduces a keyword matrix (one row per day, one column per keyword)
+    to a tuple: (baseline_avg, current_avg, volatility)
+    volatility is the coefficient of variation of the daily totals.
+    """
+    # Sum all keyword columns once into daily totals, then derive every
+    # figure below from two sums over them instead of separate mean passes
+    row_sums = np.einsum('ij->i', kw_matrix)
+    days = len(row_sums)
+    total = float(row_sums.sum())
+    recent_total = float(row_sums[-7:].sum())
+    
+    # A. Calculate Baseline (avg of all keywords in first 23 days)
+    if days > 7:
+        baseline_avg = (total - recent_total) / (days - 7)
+    else:
+        # If no baseline, set a small default to avoid division by zero
+        baseline_avg = 10.0
+    
+    # B. Calculate Current Spike (avg of all keywords in last 7 days)
+    current_avg = recent_total / min(days, 7)
+    
+    # C. Measure how much the daily totals move around
+    mean = total / days
+    volatility = float(row_sums.std() / mean) if mean > 0 else 0.0
+    
+    return baseline_avg, current_avg, volatility
+
+# Threat level and action item for each level code from _score_core
+THREAT_LEVELS = (
+    ("Low", "INFO: Normal background chatter. No immediate action required."),
+    ("Guarded", "WATCH: Search interest is above baseline. Monitor data daily and check pharmacy supplies."),
+    ("Elevated", "ALERT: Elevated search interest. Recommend alerting clinics and launching a preventative awareness campaign."),
+    ("High", "ACTION: High threat detected. Recommend immediate public advisory and resource mobilization to hospitals."),
+)
+
+# The explicit signature makes Numba compile at import, not on the first
+# request (which would block every other greenlet in the worker meanwhile).
+# No fastmath: reordered float math would truncate int(composite_score)
+# differently from plain Python and could flip the threat level.
+@njit('UniTuple(int64, 2)(float64, float64, float64)', cache=True)
+def _score_core(baseline_avg, current_avg, social_score):
+    """
+    Pure-numeric part of the threat score.
+    Returns a tuple: (score, level_code) with level_code 0-3 (Low-High)
+    """
+    # C. Calculate Trend Score (percentage increase)
+    if baseline_avg > 0:
+        percentage_increase = ((current_avg - baseline_avg) / baseline_avg) * 100
+        trend_score = max(0.0, percentage_increase) # Don't let it go negative
+    else:
+        # If baseline is 0, any traffic is a big signal
+        trend_score = current_avg * 2
+    
+    # D. Calculate Final Composite Score (70% Trends, 30% Social)
+    composite_score = (trend_score * 0.7) + (social_score * 0.3)
+    
+    # E. Determine Threat Level
+    score = int(composite_score)
+    if score > 80:
+        level_code = 3
+    elif score > 50:
+        level_code = 2
+    elif score > 25:
+        level_code = 1
+    else:
+        level_code = 0
+    return score, level_code
+
+# The compiled build must score exactly like plain Python, including right
+# at the level thresholds; if it ever doesn't, fall back to plain Python
+_SCORE_CORE_CHECKS = (
+    (40.0, 120.0, 20.0),
+    (10.0, 21.142857142857142, 10.0),
+    (0.0, 5.0, 5.0),
+    (100.0, 100.0, 50.0),
+    (40.0, 60.0, 40.0),
+    (40.0, 70.0, 30.0),
+    (10.0, 3.0, 50.0),
+)
+if hasattr(_score_core, 'py_func'):
+    for _args in _SCORE_CORE_CHECKS:
+        if _score_core(*_args) != _score_core.py_func(*_args):
+            print(f"[Score] !!! Compiled _score_core disagrees with Python for {_args}; using plain Python.")
+            _score_core = _score_core.py_func
+            break
+
+def calculate_threat_score(trend_averages, social_score, disease_config):
     """
     Calculates a "Threat Score" based on the data.
+    trend_averages is the (baseline_avg, current_avg) tuple from the cache.
     """
-    if trends_df is None or trends_df.empty:
+    if trend_averages is None:
         return 0, "Low", "No trend data available for calculation."
 
     try:
-        # A. Calculate Baseline (avg of all keywords in first 23 days)
-        baseline_df = trends_df[:-7]
-        if baseline_df.empty:
-            # If no baseline, set a small default to avoid division by zero
-            baseline_avg = 10 
-        else:
-            # Sum all keyword columns, then take the mean
-            baseline_avg = baseline_df[disease_config['keywords']].sum(axis=1).mean()
-        
-        # B. Calculate Current Spike (avg of all keywords in last 7 days)
-        current_df = trends_df[-7:]
-        current_avg = current_df[disease_config['keywords']].sum(axis=1).mean()
-        
-        # C. Calculate Trend Score (percentage increase)
-        trend_score = 0
-        if baseline_avg > 0:
-            percentage_increase = ((current_avg - baseline_avg) / baseline_avg) * 100
-            trend_score = max(0, percentage_increase) # Don't let it go negative
-        else:
-            # If baseline is 0, any traffic is a big signal
-            trend_score = current_avg * 2 
-        
-        # D. Calculate Final Composite Score (70% Trends, 30% Social)
-        composite_score = (trend_score * 0.7) + (social_score * 0.3)
-        
-        # E. Determine Threat Level & Action Item
-        score = int(composite_score)
-        if score > 80:
-            level = "High"
-            action = "ACTION: High threat detected. Recommend immediate public advisory and resource mobilization to hospitals."
-        elif score > 50:
-            level = "Elevated"
-            action = "ALERT: Elevated search interest. Recommend alerting clinics and launching a preventative awareness campaign."
-        elif score > 25:
-            level = "Guarded"
-            action = "WATCH: Search interest is above baseline. Monitor data daily and check pharmacy supplies."
-        else:
-            level = "Low"
-            action = "INFO: Normal background chatter. No immediate action required."
-            
+        baseline_avg, current_avg = trend_averages
+        score, level_code = _score_core(float(baseline_avg), float(current_avg), float(social_score))
+        level, action = THREAT_LEVELS[level_code]
         return score, level, action
         
     except Exception as e:
@@ -184,23 +792,112 @@ def calculate_threat_score(trends_df, social_score, disease_config):
 @app.route('/api/threat', methods=['GET'])
 def get_threat_analysis():
     # Get parameters from URL (e.g., .../api/threat?disease=flu&city=delhi&geo=IN-DL)
-    disease = request.args.get('disease', 'dengue')
-    city = request.args.get('city', 'kanpur')
-    geo = request.args.get('geo', 'IN-UP')
+    disease = normalize_disease(request.args.get('disease', 'dengue'))
+    city, geo = read_location_args()
     
     print(f"\n[API] Received request: disease={disease}, city={city}, geo={geo}")
     
     # Validate disease
-    if disease not in DISEASE_KEYWORDS:
+    if disease not in _VALID_DISEASES:
         return jsonify({"error": "Disease not configured"}), 400
     disease_config = DISEASE_KEYWORDS[disease]
     
+    # Serve a previously built response if it is still fresh
+    response_key = (disease, city, geo)
+    with cache_lock:
+        cached = response_cache.get(response_key)
+    if cached is not None:
+        print(f"[Cache] HIT! Serving cached response for {response_key}.")
+        return send_cached_response(cached)
+    
     # Fetch data from our functions
-    trends_df, chart_data = get_google_trends(disease_config, geo)
+    trend_averages, chart_data, expires_at = get_google_trends(disease_config, geo)
+    response_data = build_threat_report(disease, city, geo, trend_averages, chart_data)
+    
+    body = orjson.dumps(response_data)
+    # Only cache real results, so a failed Trends call is retried next time,
+    # and only for as long as the trends data they came from stays valid
+    now = CACHE_TIMER()
+    if chart_data is None or expires_at <= now:
+        return Response(body, mimetype='application/json')
+    
+    # The ETag names this exact cache entry: it changes whenever the
+    # entry is rebuilt, because it includes the trends expiry and build time
+    etag = hashlib.blake2b(f"{response_key}{expires_at}{now}".encode(), digest_size=8).hexdigest()
+    cached = {'body': body, 'etag': etag, 'ttl': expires_at - now}
+    with cache_lock:
+        response_cache[response_key] = cached
+    
+    return send_cached_response(cached)
+
+@app.route('/api/threat_batch', methods=['GET'])
+def get_threat_batch():
+    # Several diseases for one place (e.g., .../api/threat_batch?disease=flu,dengue,covid&city=delhi&geo=IN-DL)
+    diseases = [normalize_disease(d) for d in request.args.get('disease', 'dengue').split(',')]
+    city, geo = read_location_args()
+    
+    print(f"\n[API] Received batch request: diseases={diseases}, city={city}, geo={geo}")
+    
+    # Validate every disease before doing any work; drop duplicates
+    diseases = list(dict.fromkeys(diseases))
+    unknown = [d for d in diseases if d not in _VALID_DISEASES]
+    if unknown:
+        return jsonify({"error": f"Disease not configured: {', '.join(unknown)}"}), 400
+    
+    # Fetch all diseases concurrently: total latency is the slowest
+    # fetch instead of the sum of all of them
+    trends = trends_executor.map(
+        lambda d: get_google_trends(DISEASE_KEYWORDS[d], geo), diseases
+    )
+    results = [
+        build_threat_report(disease, city, geo, trend_averages, chart_data)
+        for disease, (trend_averages, chart_data, _expires_at) in zip(diseases, trends)
+    ]
+    
+    return Response(orjson.dumps({'results': results}), mimetype='application/json')
+
+def send_cached_response(cached):
+    """
+    Sends a response_cache entry, or an empty 304 Not Modified when the
+    client's If-None-Match shows it already has this version. RFC 9110
+    requires weak comparison here, so W/"..." tags (e.g. re-tagged by a
+    compressing proxy) still match.
+    """
+    if request.if_none_match.contains_weak(cached['etag']):
+        print("[API] Client copy is current, sending 304.")
+        response = Response(status=304)
+    else:
+        response = Response(cached['body'], mimetype='application/json')
+    response.set_etag(cached['etag'])
+    response.headers['Cache-Control'] = 'max-age=60'
+    return response
+
+def normalize_disease(disease):
+    """
+    Canonical, interned form of a disease name from the query string.
+    """
+    return sys.intern(disease.strip().lower())
+
+def read_location_args():
+    """
+    Reads city and geo from the query string in canonical form (lower-case
+    city, upper-case geo code). Both are interned because they end up in
+    the cache keys, which are then compared by identity first.
+    Returns a tuple: (city, geo)
+    """
+    city = sys.intern(request.args.get('city', 'kanpur').strip().lower())
+    geo = sys.intern(request.args.get('geo', 'IN-UP').strip().upper())
+    return city, geo
+
+def build_threat_report(disease, city, geo, trend_averages, chart_data):
+    """
+    Scores one disease and builds its JSON response dict.
+    """
+    disease_config = DISEASE_KEYWORDS[disease]
     social_score = get_social_chatter(disease_config, city)
     
     # Calculate the score
-    score, level, action = calculate_threat_score(trends_df, social_score, disease_config)
+    score, level, action = calculate_threat_score(trend_averages, social_score, disease_config)
     
     # Build the final JSON response
     response_data = {
@@ -215,13 +912,18 @@ def get_threat_analysis():
     
     print(f"[API] Sending response: Threat Level = {level} (Score: {score})")
     
-    return jsonify(response_data)
+    return response_data
 
 # --- 8. Run the App ---
+# This block is for local development only. In production the app is
+# served by gunicorn with gevent workers (see Procfile), so pytrends I/O
+# waits don't block other requests.
 if __name__ == '__main__':
     print("Starting Project Sentinel Backend...")
     print("Your frontend can now connect to http://<YOUR-IP-ADDRESS>:5001")
     # --- FINAL CHANGE ---
     # Listen on '0.0.0.0' to make the server accessible on your local network
     # Person 2 can connect using Person 1's IP address (e.g., http://192.168.1.10:5001)
-    app.run(host='0.0.0.0', debug=True, port=5001)
\ No newline at end of file
+    # Debug mode (reloader + in-browser debugger) is opt-in with SENTINEL_DEBUG=1:
+    # it slows every request, and the reloader's second process keeps its own cache
+    app.run(host='0.0.0.0', debug=os.getenv('SENTINEL_DEBUG') == '1', port=5001)
\ No newline at end of file